@@ -1,11 +1,20 @@
 import pickle
 import os
 import threading
+import time
 from multiprocessing.dummy import Pool as ThreadPool
-from queue import Queue
+from queue import Empty, Full, Queue
 from tqdm import tqdm
 from ctholly import utils
 
+# Disk writer defaults: threads, buffered chunks per thread, bytes per fsync
+N_WRITER = 2
+WRITE_QUEUE_SIZE = 32
+FSYNC_BYTES = 0
+
+_disk_writer = None
+_disk_writer_lock = threading.Lock()
+
 
 def download_file(url):
     downloader = FileDownloader(url, n_thread=16)
@@ -22,6 +31,27 @@ def download_manga(url, title, img_urls):
     utils.reduce_images_dimension(bd.file_dests, 720)
 
 
+def download_series(series):
+    print(f"Fetching series: {series.title} "
+          f"({len(series.chapters)} chapters)...")
+    sd = SeriesDownloader(series, n_thread=1, n_file=16, n_chapter=4)
+    print(f"Downloading {series.title} ({len(sd.batches)} chapters)...")
+    sd.run()
+    print("Cropping images...")
+    utils.reduce_images_dimension(sd.file_dests, 720)
+
+
+def dump_errors(errors, report=True):
+    """Save failed downloaders so they can be fed back into input."""
+    with open(utils.ERROR_FILE, "wb") as f:
+        pickle.dump(errors, f)
+    if report:
+        print(f"There are {len(errors)} errors.")
+        prompt = input("Do you want to retry? ")
+        if prompt.upper().startswith('Y'):
+            redownload_error()
+
+
 def redownload_error():
     with open(utils.ERROR_FILE, "rb") as f:
         errors = pickle.load(f)
@@ -36,8 +66,18 @@ def redownload_error():
     utils.reduce_images_dimension(filenames, 720)
 
 
+def get_disk_writer():
+    """Writer pool shared by every download, started on first use."""
+    global _disk_writer
+    with _disk_writer_lock:
+        if _disk_writer is None:
+            _disk_writer = DiskWriter(N_WRITER, WRITE_QUEUE_SIZE, FSYNC_BYTES)
+        return _disk_writer
+
+
 def report_download_queue(queue, total_size):
     downloaded = 0
+    stalled = 0
     t = tqdm(total=total_size,
              unit='B',
              unit_scale=True,
@@ -46,20 +86,161 @@ def report_download_queue(queue, total_size):
         msg = queue.get()
         if msg == "DONE":
             break
-        _part, _downloaded = msg
+        _part, _downloaded, _stalled = msg
         downloaded += _downloaded
         t.update(_downloaded)
+
+        # Time network threads spent waiting for a full write queue
+        if _stalled > 0:
+            stalled += _stalled
+            t.set_postfix(disk_wait=f"{stalled:.1f}s", refresh=False)
         queue.task_done()
     t.close()
 
 
+class WriteThread(threading.Thread):
+    def __init__(self, queue, errors, errors_lock, fsync_bytes=0):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.fsync_bytes = fsync_bytes
+        self.files = {}
+        self.unsynced = {}
+
+        # Shared with DiskWriter so callers can stop on the first error
+        self.errors = errors
+        self.errors_lock = errors_lock
+
+    def run(self):
+        while True:
+            # Take whatever is queued so adjacent chunks can be coalesced
+            batch = [self.queue.get()]
+            while len(batch) < self.queue.maxsize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        pending = {}
+        for filename, offset, data in batch:
+
+            # Closing request: flush what is pending and hand back the error
+            if offset is None:
+                self._flush(filename, pending.pop(filename, None))
+                self._close(filename)
+                with self.errors_lock:
+                    data.put(self.errors.pop(filename, None))
+                continue
+
+            run = pending.get(filename)
+            if run is not None and run[0] + run[1] == offset:
+                run[1] += len(data)
+                run[2].append(data)
+            else:
+                self._flush(filename, run)
+                pending[filename] = [offset, len(data), [data]]
+        for filename, run in pending.items():
+            self._flush(filename, run)
+
+    def _flush(self, filename, run):
+        if run is None or filename in self.errors:
+            return
+        offset, size, chunks = run
+        try:
+            out_file = self.files.get(filename)
+            if out_file is None:
+                mode = "r+b" if os.path.isfile(filename) else "wb"
+                out_file = self.files[filename] = open(filename, mode)
+                self.unsynced[filename] = 0
+            if out_file.tell() != offset:
+                out_file.seek(offset)
+            out_file.writelines(chunks)
+            self.unsynced[filename] += size
+            if (self.fsync_bytes and
+                    self.unsynced[filename] >= self.fsync_bytes):
+                self._fsync(filename, out_file)
+        except Exception as e:
+            self._set_error(filename, e)
+
+    def _set_error(self, filename, error):
+        with self.errors_lock:
+            self.errors.setdefault(filename, error)
+
+    def _fsync(self, filename, out_file):
+        out_file.flush()
+        os.fsync(out_file.fileno())
+        self.unsynced[filename] = 0
+
+    def _close(self, filename):
+        out_file = self.files.pop(filename, None)
+        try:
+            # Nothing written, the part still has to exist for joining
+            if out_file is None:
+                if filename not in self.errors:
+                    open(filename, "ab").close()
+                return
+            if self.fsync_bytes and self.unsynced[filename] > 0:
+                self._fsync(filename, out_file)
+            out_file.close()
+        except Exception as e:
+            self._set_error(filename, e)
+        finally:
+            self.unsynced.pop(filename, None)
+
+
+class DiskWriter:
+    """Network threads hand chunks to writer threads through bounded queues.
+
+    Chunks of a file always go to the same writer, so they are written in
+    order. A full queue blocks the caller, the wait is returned as
+    backpressure. A failed write is raised by the next `write` of that file
+    and again by `close_file`."""
+
+    def __init__(self, n_writer=2, queue_size=32, fsync_bytes=0):
+        self.errors = {}
+        self.errors_lock = threading.Lock()
+        self.queues = [Queue(queue_size) for _ in range(n_writer)]
+        self.threads = [WriteThread(queue, self.errors, self.errors_lock,
+                                    fsync_bytes)
+                        for queue in self.queues]
+        for _thread in self.threads:
+            _thread.start()
+
+    def _get_queue(self, filename):
+        return self.queues[hash(filename) % len(self.queues)]
+
+    def write(self, filename, offset, data):
+        with self.errors_lock:
+            error = self.errors.get(filename)
+        if error is not None:
+            raise error
+        queue = self._get_queue(filename)
+        try:
+            queue.put_nowait((filename, offset, data))
+            return 0
+        except Full:
+            start = time.monotonic()
+            queue.put((filename, offset, data))
+            return time.monotonic() - start
+
+    def close_file(self, filename):
+        done = Queue(1)
+        self._get_queue(filename).put((filename, None, done))
+        error = done.get()
+        if error is not None:
+            raise error
+
+
 class DownloadThread(threading.Thread):
-    def __init__(self, report_queue, url, filename, headers=None):
+    def __init__(self, report_queue, url, filename, headers=None,
+                 writer=None):
         super().__init__()
         self.report_queue = report_queue
         self.url = url
         self.filename = filename
         self.headers = dict(headers)
+        self.writer = writer or get_disk_writer()
         self.setName(filename)
 
     def try_to_get(self):
@@ -70,10 +251,14 @@ class DownloadThread(threading.Thread):
 
     def run(self):
         response = self.try_to_get()
-        with open(self.filename, "ab") as out_file:
+        offset = utils.get_size(self.filename)
+        try:
             for chunk in response.iter_content(1024 * 1024):
-                out_file.write(chunk)
-                self.report_queue.put((self.filename, len(chunk)))
+                stalled = self.writer.write(self.filename, offset, chunk)
+                offset += len(chunk)
+                self.report_queue.put((self.filename, len(chunk), stalled))
+        finally:
+            self.writer.close_file(self.filename)
 
 
 class FileDownloader(threading.Thread):
@@ -188,7 +373,9 @@ class BatchDownloader(threading.Thread):
                  n_thread=4,
                  n_file=4,
                  report=True,
-                 headers=None):
+                 headers=None,
+                 budget=None,
+                 save_errors=True):
         super().__init__()
 
         # Filenames preprocessing
@@ -215,6 +402,11 @@ class BatchDownloader(threading.Thread):
         self.downloaders = []
         self.batch_size = 0
         self.headers = headers
+        self.failed = []
+        self.save_errors = save_errors
+
+        # Concurrent files can be limited externally by sharing a semaphore
+        self.budget = budget or threading.BoundedSemaphore(n_file)
         self._init_downloaders()
 
     def _init_downloaders(self):
@@ -233,11 +425,13 @@ class BatchDownloader(threading.Thread):
 
     def _download(self, fd):
         try:
-            fd.run()
+            with self.budget:
+                fd.run()
         except Exception as e:
             self.errors.put(fd)
             self.file_dests.remove(fd.filename)
-            os.remove(fd.filename)
+            if os.path.isfile(fd.filename):
+                os.remove(fd.filename)
             if self.report:
                 print(f"@[{fd.filename}]:\n{e}")
 
@@ -259,7 +453,143 @@ class BatchDownloader(threading.Thread):
 
         # Start download
         pool = ThreadPool(self.n_file)
-        pool.map(self._download, self.downloaders)
+        try:
+            pool.map(self._download, self.downloaders)
+
+        # Wait until downloaded, errors are kept even if a download raised
+        finally:
+            pool.close()
+            pool.join()
+            if self.report:
+                self._q.put("DONE")
+                reporter.join()
+            while not self.errors.empty():
+                self.failed.append(self.errors.get())
+
+        # Error ouput can be fed back into input
+        if self.save_errors and len(self.failed) > 0:
+            dump_errors(self.failed, self.report)
+
+
+class Chapter:
+    """A titled list of image urls, fetched lazily by `get_img_urls`."""
+
+    def __init__(self, url, title, img_urls=None, get_img_urls=None):
+        self.url = url
+        self.title = utils.remove_invalid_char(title)
+        self.img_urls = img_urls
+        self._get_img_urls = get_img_urls
+
+    def get_img_urls(self):
+        if self.img_urls is None:
+            self.img_urls = self._get_img_urls(self.url)
+        return self.img_urls
+
+
+class Series:
+    """A titled list of chapters, each saved to `title/chapter.title`."""
+
+    def __init__(self, url, title, chapters):
+        self.url = url
+        self.title = utils.remove_invalid_char(title)
+        self.chapters = chapters
+
+
+class SeriesDownloader(threading.Thread):
+    def __init__(self, series,
+                 n_thread=1,
+                 n_file=16,
+                 n_chapter=4,
+                 report=True):
+        super().__init__()
+        self.series = series
+        self.n_thread = n_thread
+        self.n_file = n_file
+        self.n_chapter = n_chapter
+        self.report = report
+        self._q = Queue()
+
+        # Every chapter draws from the same file-level budget
+        self.budget = threading.BoundedSemaphore(n_file)
+        self.batches = []
+        self.file_dests = []
+        self.failed = []
+        self.unfetched = []
+        self.batch_size = 0
+        self.n_done = 0
+        self._lock = threading.Lock()
+        self._init_batches()
+
+    def _init_batches(self):
+        # Chapters with the same title must not share a directory
+        directories = []
+        used = set()
+        for chapter in self.series.chapters:
+            directory = os.path.join(self.series.title, chapter.title)
+            test_name = directory
+            i = 0
+            while os.path.normcase(test_name) in used:
+                i += 1
+                test_name = f"{directory}({i})"
+            used.add(os.path.normcase(test_name))
+            directories.append(test_name)
+
+        with ThreadPool(self.n_chapter) as chap_pool:
+            iter_map = chap_pool.imap(
+                self._fetch_chapter, zip(self.series.chapters, directories))
+            if self.report:
+                pb = tqdm(total=len(self.series.chapters), unit="Chap")
+            for batch in iter_map:
+                if batch is not None:
+                    self.batches.append(batch)
+                    self.batch_size += batch[1].batch_size
+                if self.report:
+                    pb.update()
+            if self.report:
+                pb.close()
+
+    def _fetch_chapter(self, args):
+        chapter, directory = args
+        try:
+            bd = BatchDownloader(chapter.get_img_urls(), directory, 'numeric',
+                                 self.n_thread, self.n_file, self._q,
+                                 headers={'referer': chapter.url},
+                                 budget=self.budget, save_errors=False)
+        except Exception as e:
+            with self._lock:
+                self.unfetched.append(chapter)
+            if self.report:
+                tqdm.write(f"@[{chapter.title}]:\n{e}")
+            return None
+        return chapter, bd
+
+    def _download(self, batch):
+        chapter, bd = batch
+        try:
+            bd.run()
+        except Exception as e:
+            msg = f"failed\n{e}"
+        else:
+            msg = f"{len(bd.file_dests)} files, {len(bd.failed)} errors"
+        with self._lock:
+            self.n_done += 1
+            self.file_dests.extend(bd.file_dests)
+            self.failed.extend(bd.failed)
+            if self.report:
+                tqdm.write(f"[{self.n_done}/{len(self.batches)}] "
+                           f"{chapter.title}: {msg}")
+
+    def run(self):
+
+        # Prepare report
+        if self.report:
+            reporter = threading.Thread(
+                target=report_download_queue, args=(self._q, self.batch_size))
+            reporter.start()
+
+        # Chapters overlap, files are limited by the shared budget
+        pool = ThreadPool(self.n_chapter)
+        pool.map(self._download, self.batches)
 
         # Wait until downloaded
         pool.close()
@@ -268,16 +598,8 @@ class BatchDownloader(threading.Thread):
             self._q.put("DONE")
             reporter.join()
 
-        # Error ouput can be fed back into input
-        errors = []
-        while not self.errors.empty():
-            errors.append(self.errors.get())
-
-        if len(errors) > 0:
-            with open(utils.ERROR_FILE, "wb") as f:
-                pickle.dump(errors, f)
-            if self.report:
-                print(f"There are {errors} errors.")
-                prompt = input("Do you want to retry? ")
-                if prompt.upper().startswith('Y'):
-                    redownload_error()
+        if self.report and len(self.unfetched) > 0:
+            print(f"{len(self.unfetched)} chapters could not be fetched: "
+                  + ", ".join(chapter.title for chapter in self.unfetched))
+        if len(self.failed) > 0:
+            dump_errors(self.failed, self.report)
@@ -2,10 +2,12 @@
 import logging
 import os
 import re
-import shutil
 import sys
 from ctholly import utils
-from ctholly.downloader import (download_manga,
+from ctholly.downloader import (Chapter,
+                                Series,
+                                download_manga,
+                                download_series,
                                 download_file,
                                 redownload_error)
 
@@ -49,6 +51,17 @@ def fetch_htm(url):
 _HVN = "https://hentaivn.net"
 
 
+def get_hvn_img_urls(url, html=None):
+    """Get url of images of a single chap from HVN."""
+
+    html = html or utils.get_html_text(url)
+    img_urls = re.findall(r"<img src=\"(h.+?)\"", html)[1:]
+
+    # Choose server for fast image load
+    img_server = ''
+    return [(img_server + img) for img in img_urls]
+
+
 def fetch_hvn(url, title=None):
     """Download single-chap, one-shot or a-series from HVN.
         Deprecated. HVN is downed."""
@@ -64,11 +77,7 @@ def fetch_hvn(url, title=None):
 
         # Get url of images
         title = title[0][16:] if len(title) == 1 else title
-        img_urls = re.findall(r"<img src=\"(h.+?)\"", html)[1:]
-
-        # Choose server for fast image load
-        img_server = ''
-        img_urls = [(img_server + img) for img in img_urls]
+        img_urls = get_hvn_img_urls(url, html)
 
         # Execute download
         download_manga(url, title, img_urls)
@@ -82,27 +91,17 @@ def fetch_hvn(url, title=None):
             title = re.findall(r"<title>(.+) \| Đọc Online</title>", html)[0][15:]
         else:
             title = title[0][0][15:]
-        title = utils.remove_invalid_char(title)
         chap_urls = re.findall(r"href=\"(.+?)\"><h2 class=\"chuong_t\"", html)
         chap_titles = re.findall(r"<h2 class=\"chuong_t\".+?>(.+?)</h2>", html)
-        chap_titles = [utils.remove_invalid_char(chap_title) for chap_title in chap_titles]
         assert len(chap_titles) == len(chap_urls)
         if len(chap_titles) == 1:
             return fetch_hvn(_HVN + chap_urls[0])
 
-        # Iterate through each chapter
-        print('Fetching series: {} ({} chapters)'.format(title, len(chap_titles)))
-        for url, chap in zip(chap_urls, chap_titles):
-
-            # Download chapter
-            fetch_hvn(_HVN + url, chap)
-
-            # Move chapter to series folder
-            for file in os.listdir(chap):
-                _dest = os.path.join(title, chap)
-                os.makedirs(_dest, exist_ok=True)
-                shutil.copy(os.path.join(chap, file), _dest)
-            shutil.rmtree(chap)
+        # Chapters are fetched lazily and downloaded concurrently
+        chapters = [Chapter(_HVN + chap_url, chap_title,
+                            get_img_urls=get_hvn_img_urls)
+                    for chap_url, chap_title in zip(chap_urls, chap_titles)]
+        download_series(Series(url, title, chapters))
 
 
 def fetch(url):
@@ -122,6 +122,10 @@ def fix_filename(filename):
     return filename
 
 
+def get_size(filename):
+    return getsize(filename) if isfile(filename) else 0
+
+
 def get_size_downloaded(filename):
     file_size = []
     i = 0